@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
+import os
+import sys
 import socket
+import asyncio
 import threading
+import queue
 import struct
-import json
+import orjson
 import uuid
 import time
 import hmac
@@ -13,170 +17,315 @@ from influxdb import InfluxDBClient
 # ===================== CONFIG =====================
 HOST = '0.0.0.0'
 PORT = 50023
+# Reconnect storms queue here; asyncio accepts up to this many per wakeup
+LISTEN_BACKLOG = socket.SOMAXCONN
 SHARED_SECRET = b"xx"
 ALLOWED_COMMAND_KEYS = {"uptime", "hostname", "disk", "lslogs", "metrics", "network"}
+COMMAND_TIMEOUT = 35  # seconds to wait for each agent's reply
+AUTH_TIMEOUT = 10     # seconds a new connection gets to send its auth message
+AUTH_WINDOW = 60      # seconds of clock skew accepted on auth timestamps
+MAX_MSG_SIZE = 1 << 20  # bytes; PNCP messages are small, anything bigger is refused
+
+# PNCP log: one compact JSON line per message; PNCP_DEBUG=1 also pretty-prints to stdout
+LOG_FILE = "pncp_log.txt"
+LOG_FLUSH_INTERVAL = 1.0  # seconds
+DEBUG = os.environ.get("PNCP_DEBUG", "").lower() in {"1", "true", "yes", "on"}
+
+# TCP keepalive: kernel probes after 30s idle, every 10s, drops after 3 misses
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
 
 # InfluxDB config
 INFLUX_HOST = "localhost"
 INFLUX_PORT = 8086
 INFLUX_DB = "pimetrics"
+INFLUX_BATCH_SIZE = 5000      # max points per write_points call
+INFLUX_FLUSH_INTERVAL = 1.0   # seconds to wait for a batch to fill
+INFLUX_QUEUE_SIZE = 100000    # points buffered while InfluxDB is slow or down
 
 # ===================== SETUP INFLUX =====================
-influx_client = InfluxDBClient(host=INFLUX_HOST, port=INFLUX_PORT)
-influx_client.create_database(INFLUX_DB)
-influx_client.switch_database(INFLUX_DB)
+# The client keeps one pooled keep-alive requests.Session, so batches reuse
+# a TCP connection instead of paying a handshake per request.
+influx_client = InfluxDBClient(host=INFLUX_HOST, port=INFLUX_PORT, pool_size=16)
+influx_client.switch_database(INFLUX_DB)  # database is (re)created by the flusher
 
 # ===================== PNCP MESSAGE LOGGER =====================
+# Opened once and buffered; flush_log_periodically pushes it to disk
+try:
+    _log_fh = open(LOG_FILE, "ab", buffering=65536)
+except OSError:
+    _log_fh = None
+
 def log_pncp_message(direction, addr, msg):
-    msg_type = msg.get("type", "unknown").upper()
-    print(f"\n==============================\n📡 PNCP {direction} MESSAGE ({msg_type}) from {addr}\n==============================")
-    print(json.dumps(msg, indent=2))
-    print("==============================\n")
-    try:
-        with open("pncp_log.txt", "a") as f:
-            f.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {direction} from {addr}\n")
-            f.write(json.dumps(msg, indent=2))
-            f.write("\n\n")
-    except Exception:
-        pass
+    if DEBUG:
+        msg_type = msg.get("type", "unknown").upper()
+        print(f"\n==============================\n📡 PNCP {direction} MESSAGE ({msg_type}) from {addr}\n==============================")
+        print(orjson.dumps(msg, option=orjson.OPT_INDENT_2).decode())
+        print("==============================\n")
+    if _log_fh:
+        try:
+            _log_fh.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {direction} from {addr} ".encode()
+                          + orjson.dumps(msg) + b"\n")
+        except Exception:
+            pass
+
+async def flush_log_periodically():
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        if _log_fh:
+            try:
+                _log_fh.flush()
+            except Exception:
+                pass
 
 # ===================== SOCKET HELPERS =====================
-def send_msg(conn, obj, addr=None):
-    data = json.dumps(obj).encode('utf-8')
+_HDR = struct.Struct('>I')  # PNCP frame header: big-endian payload length
+
+def enable_keepalive(sock):
+    """Lets the kernel detect dead peers so idle agents need no polling."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+
+async def send_msg(writer, obj, addr=None):
+    data = orjson.dumps(obj)
     if addr:
         log_pncp_message("SEND", addr, obj)
-    conn.sendall(struct.pack('>I', len(data)) + data)
-
-def recv_msg(conn, addr=None):
-    hdr = conn.recv(4)
-    if not hdr:
-        return None
-    (length,) = struct.unpack('>I', hdr)
-    payload = b''
-    while len(payload) < length:
-        chunk = conn.recv(length - len(payload))
-        if not chunk:
-            raise ConnectionError('Socket closed mid-message')
-        payload += chunk
-    msg = json.loads(payload.decode('utf-8'))
+    writer.write(_HDR.pack(len(data)) + data)
+    await writer.drain()
+
+async def recv_msg(reader, addr=None):
+    try:
+        hdr = await reader.readexactly(_HDR.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError('Socket closed mid-header')
+    (length,) = _HDR.unpack(hdr)
+    if length > MAX_MSG_SIZE:
+        raise ConnectionError(f'Oversized frame ({length} bytes)')
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError('Socket closed mid-message')
+    msg = orjson.loads(payload)
     if addr:
         log_pncp_message("RECV", addr, msg)
     return msg
 
 # ===================== GLOBAL AGENTS =====================
-connected_agents = {}
-agents_lock = threading.Lock()
+# Everything below is only touched from the event loop thread, so no locks.
+# connected_agents is copy-on-write: it is replaced, never mutated, so a
+# reference taken before an await is a stable snapshot.
+connected_agents = {}   # agent_id -> (reader, writer)
+pending_results = {}    # (agent_id, req_id) -> Future resolved by the agent's handler
+
+def register_agent(agent_id, streams):
+    global connected_agents
+    connected_agents = {**connected_agents, agent_id: streams}
+
+def unregister_agent(agent_id):
+    global connected_agents
+    if agent_id in connected_agents:
+        connected_agents = {k: v for k, v in connected_agents.items() if k != agent_id}
 
 # ===================== METRICS PRINT =====================
-def print_metrics(agent_id, metrics_json):
+_KB = 1.0 / 1024
+_MB = 1.0 / 1024**2
+_GB = 1.0 / 1024**3
+
+def print_metrics(agent_id, metrics):
     try:
-        metrics = json.loads(metrics_json)
-        print(f"\n[{agent_id}] Metrics:")
-        print("CPU usage per core:", metrics['cpu_percent'])
         mem = metrics['memory']
-        print(f"Memory: {mem['used'] / (1024**2):.1f} MB used / {mem['total'] / (1024**2):.1f} MB total ({mem['percent']}%)")
-        swap = mem
-        print(f"Swap: {swap['swap_used'] / (1024**2):.1f} MB used / {swap['swap_total'] / (1024**2):.1f} MB total ({swap['swap_percent']}%)")
         load = metrics['load_avg']
-        print(f"Load Average: 1min={load['1min']}, 5min={load['5min']}, 15min={load['15min']}")
         disk = metrics['disk']
-        print(f"Disk: {disk['used'] / (1024**3):.2f} GB used / {disk['total'] / (1024**3):.2f} GB total ({disk['percent']}%)")
+        lines = [
+            f"\n[{agent_id}] Metrics:",
+            f"CPU usage per core: {metrics['cpu_percent']}",
+            f"Memory: {mem['used'] * _MB:.1f} MB used / {mem['total'] * _MB:.1f} MB total ({mem['percent']}%)",
+            f"Swap: {mem['swap_used'] * _MB:.1f} MB used / {mem['swap_total'] * _MB:.1f} MB total ({mem['swap_percent']}%)",
+            f"Load Average: 1min={load['1min']}, 5min={load['5min']}, 15min={load['15min']}",
+            f"Disk: {disk['used'] * _GB:.2f} GB used / {disk['total'] * _GB:.2f} GB total ({disk['percent']}%)",
+        ]
         net = metrics.get('net', {})
         if net:
-            print("Network Interfaces:")
+            lines.append("Network Interfaces:")
             for iface, stats in net.items():
-                print(f"  {iface}: {stats['bytes_sent']/1024:.2f} KB sent, {stats['bytes_recv']/1024:.2f} KB received")
-        print("-" * 40)
+                lines.append(f"  {iface}: {stats['bytes_sent'] * _KB:.2f} KB sent, {stats['bytes_recv'] * _KB:.2f} KB received")
+        lines.append("-" * 40)
+        # One write to stdout instead of one per line
+        print("\n".join(lines))
     except Exception as e:
         print(f"[-] Failed to parse metrics from {agent_id}: {e}")
-        print(metrics_json)
+        print(metrics)
 
 # ===================== INFLUX WRITE =====================
+# Points are queued and written in batches by a background flusher so that a
+# command cycle over N agents costs one HTTP request instead of N. Timestamps
+# are integer epoch seconds. Nothing on the event loop ever waits on InfluxDB.
+_influx_q = queue.Queue(INFLUX_QUEUE_SIZE)
+_INFLUX_STOP = object()
+
+def _flusher():
+    # Create the database before the first write and again after any failed
+    # write, so the writer recovers once InfluxDB becomes reachable.
+    db_ready = False
+    stopping = False
+    while not stopping:
+        point = _influx_q.get()
+        if point is _INFLUX_STOP:
+            break
+        points = [point]
+        deadline = time.monotonic() + INFLUX_FLUSH_INTERVAL
+        while len(points) < INFLUX_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                point = _influx_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if point is _INFLUX_STOP:
+                stopping = True
+                break
+            points.append(point)
+        try:
+            if not db_ready:
+                influx_client.create_database(INFLUX_DB)
+                db_ready = True
+            influx_client.write_points(points, time_precision='s', batch_size=INFLUX_BATCH_SIZE)
+        except Exception as e:
+            db_ready = False
+            print(f"[-] Failed to write {len(points)} points to InfluxDB: {e}")
+
+_influx_thread = threading.Thread(target=_flusher, daemon=True)
+_influx_thread.start()
+
+def drain_influx(timeout=5.0):
+    """Flushes queued points and stops the writer thread."""
+    try:
+        _influx_q.put(_INFLUX_STOP, timeout=timeout)
+    except queue.Full:
+        return
+    _influx_thread.join(timeout)
+
+def queue_point(point):
+    """Hands a point to the flusher without blocking. Returns False if it was dropped."""
+    try:
+        _influx_q.put_nowait(point)
+        return True
+    except queue.Full:
+        print(f"[-] InfluxDB queue full, dropping {point['measurement']} point")
+        return False
+
 def store_in_influx(agent_id, command, output):
-    measurement = command.lower()
-    json_body = [{
-        "measurement": measurement,
+    # Structured outputs (metrics) arrive as dicts and are stored as JSON text
+    if not isinstance(output, str):
+        output = orjson.dumps(output).decode()
+    queue_point({
+        "measurement": command.lower(),
         "tags": {"agent": agent_id},
-        "time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
-        "fields": {"output": str(output)}
-    }]
-    try:
-        influx_client.write_points(json_body)
-    except Exception as e:
-        print(f"[-] Failed to write {agent_id}/{command} to InfluxDB: {e}")
+        "time": int(time.time()),
+        "fields": {"output": output}
+    })
+
+# ===================== AUTH WINDOW =====================
+# Expected HMAC for every timestamp currently inside +/-AUTH_WINDOW, so
+# validating an auth message is a dict lookup instead of a SHA-256.
+_auth_digests = {}
+_NO_DIGEST = bytes(32)
+
+def refresh_auth_window():
+    now = int(time.time())
+    for ts in range(now - AUTH_WINDOW, now + AUTH_WINDOW + 1):
+        if ts not in _auth_digests:
+            _auth_digests[ts] = hmac.new(SHARED_SECRET, str(ts).encode(), hashlib.sha256).digest()
+    # Evict on both sides so a backwards clock step cannot leave future digests valid
+    for ts in [t for t in _auth_digests if abs(t - now) > AUTH_WINDOW]:
+        del _auth_digests[ts]
+
+async def refresh_auth_window_periodically():
+    while True:
+        await asyncio.sleep(1)
+        refresh_auth_window()
 
 # ===================== AGENT HANDLER =====================
-class AgentHandler(threading.Thread):
-    def __init__(self, conn, addr):
-        super().__init__(daemon=True)
-        self.conn = conn
-        self.addr = addr
+class AgentHandler:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername')
         self.agent_id = None
 
-    def run(self):
+    async def run(self):
         try:
             print(f"[+] Connection from {self.addr}")
-            msg = recv_msg(self.conn, self.addr)
+            enable_keepalive(self.writer.get_extra_info('socket'))
+            try:
+                msg = await asyncio.wait_for(recv_msg(self.reader, self.addr), AUTH_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f'[-] No auth within {AUTH_TIMEOUT}s, closing')
+                return
             if not msg or msg.get('type') != 'auth':
                 print('[-] Expected auth, closing')
-                self.conn.close()
                 return
 
             if not self.validate_auth(msg):
                 print('[-] Auth failed')
-                send_msg(self.conn, {'type': 'auth_result', 'ok': False}, self.addr)
-                self.conn.close()
+                await send_msg(self.writer, {'type': 'auth_result', 'ok': False}, self.addr)
                 return
 
             base_name = msg.get('agent', f'{self.addr[0]}')
             self.agent_id = f"{base_name}_{self.addr[0]}:{self.addr[1]}"
 
-            with agents_lock:
-                connected_agents[self.agent_id] = self.conn
+            register_agent(self.agent_id, (self.reader, self.writer))
 
-            send_msg(self.conn, {'type': 'auth_result', 'ok': True}, self.addr)
+            await send_msg(self.writer, {'type': 'auth_result', 'ok': True}, self.addr)
             print(f"[+] Agent authenticated: {self.agent_id}")
 
             # Log connection to InfluxDB
             self.log_agent_status("connected")
 
             # Start monitoring
-            self.monitor_connection()
+            await self.monitor_connection()
 
         except Exception as e:
             print(f"[-] Exception in handler for {self.addr}: {e}")
         finally:
             self.cleanup()
 
-    def monitor_connection(self):
-        """Periodically checks if the agent is still connected."""
-        try:
-            while True:
-                self.conn.settimeout(3.0)
-                try:
-                    test = self.conn.recv(1, socket.MSG_PEEK)
-                    if not test:
-                        print(f"[!] Agent disconnected (no data): {self.agent_id}")
-                        break
-                except socket.timeout:
-                    continue  # still alive
-                except (ConnectionResetError, ConnectionAbortedError):
-                    print(f"[!] Agent forcibly disconnected: {self.agent_id}")
-                    break
-                except Exception as e:
-                    print(f"[-] Error checking connection for {self.agent_id}: {e}")
-                    break
-                time.sleep(3)
-        except Exception as e:
-            print(f"[-] Monitor error for {self.agent_id}: {e}")
+    async def monitor_connection(self):
+        """Reads agent messages until EOF or a keepalive timeout, handing results to waiting commands."""
+        while True:
+            try:
+                msg = await recv_msg(self.reader, self.agent_id)
+            except ConnectionError:
+                print(f"[!] Agent forcibly disconnected: {self.agent_id}")
+                break
+            except Exception as e:
+                print(f"[-] Error reading from {self.agent_id}: {e}")
+                break
+            if msg is None:
+                print(f"[!] Agent disconnected (no data): {self.agent_id}")
+                break
+            fut = pending_results.pop((self.agent_id, msg.get('id')), None)
+            if fut and not fut.done():
+                fut.set_result(msg)
+            else:
+                print(f"[-] Unexpected message from {self.agent_id}: {msg}")
 
     def cleanup(self):
-        """Removes agent and logs disconnection."""
-        with agents_lock:
-            if self.agent_id in connected_agents:
-                del connected_agents[self.agent_id]
+        """Removes agent, fails its pending commands and logs disconnection."""
+        unregister_agent(self.agent_id)
+        for key in [k for k in pending_results if k[0] == self.agent_id]:
+            fut = pending_results.pop(key)
+            if not fut.done():
+                fut.set_exception(ConnectionError('Agent disconnected'))
         try:
-            self.conn.close()
+            self.writer.close()
         except:
             pass
         if self.agent_id:
@@ -186,47 +335,79 @@ class AgentHandler(threading.Thread):
             print(f"[*] Connection closed: {self.addr}")
 
     def validate_auth(self, msg):
+        """Checks HMAC and timestamp with the same work whichever one fails."""
         try:
             ts = int(msg.get('ts', 0))
-        except:
-            return False
-        if abs(int(time.time()) - ts) > 60:
-            print("[-] Timestamp out of range")
-            return False
+        except (TypeError, ValueError):
+            ts = 0
+        client_digest = b'\x00' * 32
         client_hmac = msg.get('hmac', '')
-        expected = hmac.new(SHARED_SECRET, str(ts).encode(), hashlib.sha256).hexdigest()
-        return hmac.compare_digest(client_hmac, expected)
+        if isinstance(client_hmac, str) and len(client_hmac) == 64:
+            try:
+                client_digest = bytes.fromhex(client_hmac)
+            except ValueError:
+                pass
+        expected = _auth_digests.get(ts)
+        fresh = expected is not None
+        # Out-of-window timestamps still pay for a comparison
+        mac_ok = hmac.compare_digest(client_digest, expected if fresh else _NO_DIGEST)
+        return mac_ok & fresh
 
     def log_agent_status(self, status):
         """Logs connection/disconnection to InfluxDB."""
-        json_body = [{
+        queued = queue_point({
             "measurement": "agent_status",
             "tags": {"agent": self.agent_id},
-            "time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "time": int(time.time()),
             "fields": {"status": status}
-        }]
-        try:
-            influx_client.write_points(json_body)
-            print(f"[InfluxDB] Logged {self.agent_id} as {status}")
-        except Exception as e:
-            print(f"[-] Failed to log agent status for {self.agent_id}: {e}")
+        })
+        if queued:
+            print(f"[InfluxDB] Queued {self.agent_id} as {status}")
 
 # ===================== COMMAND LOOP =====================
-def command_loop():
+async def send_command(agent_id, writer, cmd, req_id):
+    """Sends a command to one agent and waits for its matching result."""
+    fut = asyncio.get_running_loop().create_future()
+    pending_results[(agent_id, req_id)] = fut
+    try:
+        await send_msg(writer, {'type': 'cmd', 'id': req_id, 'cmd': cmd}, agent_id)
+        return await asyncio.wait_for(fut, COMMAND_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f'No response within {COMMAND_TIMEOUT}s')
+    finally:
+        pending_results.pop((agent_id, req_id), None)
+
+def read_stdin(loop, lines):
+    """Feeds stdin lines to the event loop; None marks EOF.
+
+    Reads the raw file so the thread never holds the buffered stdin lock,
+    which would abort interpreter shutdown while it is blocked.
+    """
+    stdin = sys.stdin.buffer.raw
     while True:
+        data = stdin.readline()
+        line = data.decode(errors='replace') if data else None
         try:
-            cmd = input(f"cmd to all Pis (keys: {sorted(ALLOWED_COMMAND_KEYS)}, blank to close): ").strip()
-        except EOFError:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        except RuntimeError:
+            return  # event loop already closed
+        if line is None:
+            return
+
+async def command_loop():
+    lines = asyncio.Queue()
+    # Reading stdin blocks, so it runs on a daemon thread that shutdown never joins
+    threading.Thread(target=read_stdin, args=(asyncio.get_running_loop(), lines), daemon=True).start()
+    prompt = f"cmd to all Pis (keys: {sorted(ALLOWED_COMMAND_KEYS)}, blank to close): "
+    while True:
+        print(prompt, end='', flush=True)
+        line = await lines.get()
+        if line is None:
             print("[!] EOF detected. Exiting controller...")
             break
+        cmd = line.strip()
 
         if not cmd:
-            print("[*] Closing all connections")
-            with agents_lock:
-                for conn in connected_agents.values():
-                    try: conn.close()
-                    except: pass
-                connected_agents.clear()
             break
 
         if cmd not in ALLOWED_COMMAND_KEYS:
@@ -234,50 +415,81 @@ def command_loop():
             continue
 
         req_id = str(uuid.uuid4())
-        with agents_lock:
-            agents = list(connected_agents.items())
+        agents = connected_agents
         if not agents:
             print("[*] Waiting for agents to connect...")
-            time.sleep(1)
+            await asyncio.sleep(1)
             continue
 
-        for agent_id, conn in agents:
-            try:
-                send_msg(conn, {'type': 'cmd', 'id': req_id, 'cmd': cmd}, agent_id)
-                resp = recv_msg(conn, agent_id)
-                if resp and resp.get('type') == 'result' and resp.get('id') == req_id:
-                    if cmd == 'metrics':
-                        print_metrics(agent_id, resp.get('output'))
-                    else:
-                        print(f"[{agent_id}] rc={resp.get('rc')}\nOutput:\n{resp.get('output')}")
-                    store_in_influx(agent_id, cmd, resp.get('output'))
+        # Send to every agent first, then wait for all replies together
+        results = await asyncio.gather(
+            *(send_command(agent_id, writer, cmd, req_id) for agent_id, (_, writer) in agents.items()),
+            return_exceptions=True)
+
+        for agent_id, resp in zip(agents, results):
+            if isinstance(resp, Exception):
+                print(f"[-] Error communicating with {agent_id}: {resp}")
+            elif resp and resp.get('type') == 'result' and resp.get('id') == req_id:
+                if cmd == 'metrics':
+                    print_metrics(agent_id, resp.get('output'))
                 else:
-                    print(f"[-] Unexpected response from {agent_id}: {resp}")
-            except Exception as e:
-                print(f"[-] Error communicating with {agent_id}: {e}")
+                    print(f"[{agent_id}] rc={resp.get('rc')}\nOutput:\n{resp.get('output')}")
+                store_in_influx(agent_id, cmd, resp.get('output'))
+            else:
+                print(f"[-] Unexpected response from {agent_id}: {resp}")
 
-# ===================== ACCEPT LOOP =====================
-def accept_loop(sock):
-    print("[DEBUG] Accept loop started, waiting for agent connections...")
+# ===================== MAIN SERVER =====================
+# Every open connection, authenticated or not, so shutdown can close them all
+handler_tasks = set()
+open_writers = set()
+
+async def handle_agent(reader, writer):
+    task = asyncio.current_task()
+    handler_tasks.add(task)
+    open_writers.add(writer)
     try:
-        while True:
-            conn, addr = sock.accept()
-            AgentHandler(conn, addr).start()
-    except Exception as e:
-        print("Accept loop stopped:", e)
+        await AgentHandler(reader, writer).run()
+    finally:
+        handler_tasks.discard(task)
+        open_writers.discard(writer)
 
-# ===================== MAIN SERVER =====================
-def start_server():
-    print("[DEBUG] Starting PNCP Controller...")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((HOST, PORT))
-    sock.listen(50)
+async def main():
+    refresh_auth_window()
+    auth_refresher = asyncio.create_task(refresh_auth_window_periodically())
+    # asyncio's epoll-backed loop watches every agent socket from one thread
+    server = await asyncio.start_server(handle_agent, HOST, PORT, backlog=LISTEN_BACKLOG)
     print(f"[+] Controller listening on {HOST}:{PORT}")
     print("[DEBUG] Ready to accept connections.")
+    log_flusher = asyncio.create_task(flush_log_periodically())
+    try:
+        await command_loop()
+    finally:
+        # Runs on Ctrl-C too. Not awaiting server.wait_closed(): on 3.12+ it
+        # waits for every client connection, which we close ourselves.
+        server.close()
+        print("[*] Closing all connections")
+        for writer in list(open_writers):
+            try: writer.close()
+            except: pass
+        # Let handlers see their closed connections and log the disconnect
+        if handler_tasks:
+            await asyncio.wait(handler_tasks, timeout=2.0)
+        log_flusher.cancel()
+        auth_refresher.cancel()
 
-    threading.Thread(target=accept_loop, args=(sock,), daemon=True).start()
-    command_loop()
+def start_server():
+    print("[DEBUG] Starting PNCP Controller...")
+    try:
+        asyncio.run(main())
+    finally:
+        # Handlers are cancelled on exit and queue their disconnects first
+        print("[*] Flushing pending InfluxDB writes")
+        drain_influx()
+        if _log_fh:
+            try:
+                _log_fh.close()
+            except Exception:
+                pass
 
 # ===================== ENTRY POINT =====================
 if __name__ == '__main__':
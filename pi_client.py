@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
+import os
 import socket
 import struct
-import json
+import orjson
 import time
 import hmac
 import hashlib
@@ -11,39 +12,83 @@ import uuid
 CONTROLLER_HOST = '192.168.1.136'  # Your controller IP
 CONTROLLER_PORT = 50023
 SHARED_SECRET = b"xx"
+RECV_SIZE = 65536  # one recv normally returns the header and the whole payload
+DISK_CACHE_TTL = 10  # seconds; disk usage changes slowly
+MAX_MSG_SIZE = 1 << 20  # bytes; PNCP messages are small, anything bigger is refused
 
-COMMAND_MAP = {
-    'uptime': None,     # will generate programmatically
-    'hostname': None,   # programmatically
-    'disk': None,       # programmatically
-    'lslogs': ['/usr/bin/ls', '/var/log'],
-    'metrics': None     # new command for CPU/memory/load/disk
-}
+_HDR = struct.Struct('>I')  # PNCP frame header: big-endian payload length
 
 def send_msg(conn, obj):
-    data = json.dumps(obj).encode('utf-8')
-    conn.sendall(struct.pack('>I', len(data)) + data)
-
-def recv_msg(conn):
-    hdr = conn.recv(4)
-    if not hdr:
-        return None
-    (length,) = struct.unpack('>I', hdr)
-    payload = b''
-    while len(payload) < length:
-        chunk = conn.recv(length - len(payload))
-        if not chunk:
-            raise ConnectionError('Socket closed mid-message')
-        payload += chunk
-    return json.loads(payload.decode('utf-8'))
+    data = orjson.dumps(obj)
+    conn.sendall(_HDR.pack(len(data)) + data)
+
+class MsgReader:
+    """Reads length-prefixed messages into one reusable buffer, keeping bytes past the current frame."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.buf = bytearray(RECV_SIZE)
+        self.start = 0  # first unparsed byte
+        self.end = 0    # end of received data
+
+    def _fill(self, n):
+        """Receives until n unparsed bytes are buffered. Returns False on EOF before any data."""
+        if self.end - self.start >= n:
+            return True
+        if self.start + n > len(self.buf):
+            # Shift the unparsed tail to the front; grow only for frames bigger than the buffer
+            size = self.end - self.start
+            if n > len(self.buf):
+                self.buf.extend(bytes(n - len(self.buf)))
+            self.buf[:size] = self.buf[self.start:self.end]
+            self.start, self.end = 0, size
+        with memoryview(self.buf) as view:
+            while self.end - self.start < n:
+                got = self.conn.recv_into(view[self.end:])
+                if not got:
+                    if self.end > self.start:
+                        raise ConnectionError('Socket closed mid-message')
+                    return False
+                self.end += got
+        return True
+
+    def recv_msg(self):
+        if not self._fill(_HDR.size):
+            return None
+        (length,) = _HDR.unpack_from(self.buf, self.start)
+        if length > MAX_MSG_SIZE:
+            raise ConnectionError(f'Oversized frame ({length} bytes)')
+        self._fill(_HDR.size + length)
+        start = self.start + _HDR.size
+        self.start = start + length
+        with memoryview(self.buf) as view:
+            msg = orjson.loads(view[start:self.start])
+        if self.start == self.end:
+            self.start = self.end = 0
+        return msg
+
+# Static or slow-changing system data, read once instead of on every command
+_BOOT = psutil.boot_time()
+_disk_cache = (0.0, None)
+# Prime the CPU counters so later interval=None calls return usage since the previous call
+psutil.cpu_percent(interval=None, percpu=True)
+
+def disk_usage():
+    """psutil.disk_usage('/'), cached for DISK_CACHE_TTL seconds."""
+    global _disk_cache
+    now = time.monotonic()
+    stamp, disk = _disk_cache
+    if disk is None or now - stamp > DISK_CACHE_TTL:
+        disk = psutil.disk_usage('/')
+        _disk_cache = (now, disk)
+    return disk
 
 def collect_metrics():
     """Collect CPU, memory, load average, disk usage."""
-    cpu_percents = psutil.cpu_percent(percpu=True)
+    cpu_percents = psutil.cpu_percent(interval=None, percpu=True)
     mem = psutil.virtual_memory()
     swap = psutil.swap_memory()
     load1, load5, load15 = psutil.getloadavg()
-    disk = psutil.disk_usage('/')
+    disk = disk_usage()
 
     return {
         "cpu_percent": cpu_percents,
@@ -66,46 +111,55 @@ def collect_metrics():
         }
     }
 
+# Commands are plain Python callables returning (rc, output); nothing forks
+def cmd_uptime():
+    load1, load5, load15 = psutil.getloadavg()
+    users = len(psutil.users())
+    uptime_sec = time.time() - _BOOT
+    return 0, f"uptime_sec={uptime_sec}, users={users}, load_avg=({load1}, {load5}, {load15})"
+
+def cmd_hostname():
+    return 0, socket.gethostname()
+
+def cmd_disk():
+    disk = disk_usage()
+    return 0, f"Total: {disk.total}, Used: {disk.used}, Free: {disk.free}, Percent: {disk.percent}"
+
+def cmd_lslogs():
+    # Same listing as `ls /var/log`, without a fork+exec
+    names = sorted(e.name for e in os.scandir('/var/log') if not e.name.startswith('.'))
+    return 0, ''.join(f"{name}\n" for name in names)
+
+def cmd_metrics():
+    return 0, collect_metrics()
+
+COMMAND_MAP = {
+    'uptime': cmd_uptime,
+    'hostname': cmd_hostname,
+    'disk': cmd_disk,
+    'lslogs': cmd_lslogs,
+    'metrics': cmd_metrics,  # CPU/memory/load/disk
+}
+
 def run_mapped_command(key):
-    if key not in COMMAND_MAP:
+    command = COMMAND_MAP.get(key)
+    if command is None:
         return 1, "Command key not allowed"
     try:
-        if key == 'uptime':
-            load1, load5, load15 = psutil.getloadavg()
-            users = len(psutil.users())
-            uptime_sec = time.time() - psutil.boot_time()
-            output = f"uptime_sec={uptime_sec}, users={users}, load_avg=({load1}, {load5}, {load15})"
-            return 0, output
-
-        elif key == 'hostname':
-            import socket
-            return 0, socket.gethostname()
-
-        elif key == 'disk':
-            disk = psutil.disk_usage('/')
-            output = f"Total: {disk.total}, Used: {disk.used}, Free: {disk.free}, Percent: {disk.percent}"
-            return 0, output
-
-        elif key == 'metrics':
-            metrics = collect_metrics()
-            return 0, json.dumps(metrics)
-
-        else:
-            import subprocess
-            proc = subprocess.run(COMMAND_MAP[key], capture_output=True, text=True, timeout=30)
-            return proc.returncode, proc.stdout + proc.stderr
-    except subprocess.TimeoutExpired:
-        return -124, "Command timeout"
+        return command()
     except Exception as e:
         return -1, str(e)
 
 def main():
     sock = socket.create_connection((CONTROLLER_HOST, CONTROLLER_PORT))
+    # Frames are written whole with one sendall, so Nagle only adds latency
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = MsgReader(sock)
 
     ts = int(time.time())
     h = hmac.new(SHARED_SECRET, str(ts).encode(), hashlib.sha256).hexdigest()
     send_msg(sock, {'type':'auth', 'agent':'pi-1', 'ts': ts, 'hmac': h})
-    auth_resp = recv_msg(sock)
+    auth_resp = reader.recv_msg()
     if not auth_resp or not auth_resp.get('ok'):
         print("Authentication failed")
         sock.close()
@@ -114,7 +168,7 @@ def main():
 
     try:
         while True:
-            msg = recv_msg(sock)
+            msg = reader.recv_msg()
             if msg is None:
                 print("Controller disconnected")
                 break